@@ -3,19 +3,24 @@
 # --------------------------------------------------------------------------
 
 import os
+import asyncio
 from datetime import datetime
+from functools import lru_cache
 import pytz
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Tuple
 #from agents import enable_verbose_stdout_logging     #only uncomment when logging is needed
 
 
 from dotenv import load_dotenv, find_dotenv
 
+from semantic_cache import research_cache
+
 try:
-    from firecrawl import FirecrawlApp
+    from firecrawl import FirecrawlApp, AsyncFirecrawlApp
 except ImportError:
     print("Install 'firecrawl' for the deep research tool: uv add firecrawl")
     FirecrawlApp = None
+    AsyncFirecrawlApp = None
 
 try:
     from agents import Agent, RunConfig, AsyncOpenAI, OpenAIChatCompletionsModel, Runner, handoff
@@ -35,6 +40,12 @@ except ImportError as e:
 # Load environment variables needed by the agent core (e.g., API keys)
 load_dotenv(find_dotenv())
 
+# Shared async FireCrawl client, created once so tool calls don't rebuild it per request
+_FC_API_KEY = os.getenv("FireCrawl_API_KEY")
+_FC_APP = None
+if AsyncFirecrawlApp is not None and _FC_API_KEY:
+    _FC_APP = AsyncFirecrawlApp(api_key=_FC_API_KEY)
+
 # --------------------------------------------------------------------------
 # Step 1: Provider, Step 2: Model, Step 3: Run Configuration 
 # --------------------------------------------------------------------------
@@ -44,8 +55,10 @@ provider = AsyncOpenAI(
     base_url="https://generativelanguage.googleapis.com/v1beta/openai/",
 )
 
+GEMINI_MODEL = "gemini-2.0-flash"
+
 model = OpenAIChatCompletionsModel(
-    model="gemini-2.0-flash", 
+    model=GEMINI_MODEL, 
     openai_client=provider,
 )
 
@@ -68,49 +81,109 @@ run_config = RunConfig(
 # Tool Definitions
 # --------------------------------------------------------------------------
 
-@function_tool
-async def research_topic(
-    query: str,
-    max_depth: int,
-    time_limit: int,
-    max_urls: int
-) -> Dict[str, Any]:
+# Seconds a research result stays cached; prices go stale much faster
+RESEARCH_CACHE_TTL = 3600
+FINANCIAL_CACHE_TTL = 300
+
+# In-flight FireCrawl crawls by cache key
+_inflight: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+
+
+async def _coalesced_deep_research(tool: str, query: str, **params: Any) -> Dict[str, Any]:
     """
-    Web-search via FireCrawl API for the latest, authentic sources.**Immediately retry** if the retrieved data timestamp is older than the current timestamp.
-    Perform a quick web search for a given topic, returning latest information and summaries from a few top results.
-    Use this for general questions or when a brief overview is needed. Do NOT use for deep analysis or synthesis.
-    Requires parameters: query (str), max_depth (int, e.g., 5), time_limit (int, seconds, e.g., 180), max_urls (int, e.g., 10). Always use max_depth=5, time_limit=180, max_urls=10 unless the user specifies different numbers.
+    Run FireCrawl deep_research once per (tool, query) among concurrent callers.
+    FireCrawl has no batch endpoint for deep research, so calls arriving while an
+    identical crawl is in flight (e.g. parallel tool calls) await its result instead.
     """
+    key = research_cache.key(tool, query)
+    task = _inflight.get(key)
+    if task is None:
+        # The async client polls the crawl with non-blocking sleeps, so a crawl
+        # running for up to time_limit seconds holds no thread
+        task = asyncio.ensure_future(_FC_APP.deep_research(query, **params))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _crawl_done(key, t))
+    return await asyncio.shield(task)
+
+
+def _crawl_done(key: str, task: "asyncio.Future[Dict[str, Any]]") -> None:
+    """Drop a finished crawl from _inflight, retrieving its error in case every caller was cancelled."""
+    _inflight.pop(key, None)
+    if not task.cancelled() and task.exception() is not None:
+        print(f"ERROR: FireCrawl deep_research failed for '{key}': {task.exception()}")
+
+
+# preset -> (max_depth, time_limit, max_urls, cache_ttl)
+_PRESETS: Dict[str, Tuple[int, int, int, int]] = {
+    "quick":     (5, 180, 10, RESEARCH_CACHE_TTL),
+    "deep":      (10, 300, 50, RESEARCH_CACHE_TTL),
+    "financial": (10, 300, 50, FINANCIAL_CACHE_TTL),
+}
+
+
+async def _fc(query: str, preset: str) -> Dict[str, Any]:
+    """Shared body of the FireCrawl research tools: cache lookup, crawl and result extraction."""
     if FirecrawlApp is None:
         print("ERROR: firecrawl-python library is required for deep_research but not installed.")
         return {"error": "Deep research tool dependency missing.", "success": False}
 
+    max_depth, time_limit, max_urls, cache_ttl = _PRESETS[preset]
     try:
-        fc_api_key = os.getenv("FireCrawl_API_KEY")
-        if not fc_api_key:
+        cached = await research_cache.get(preset, query)
+        if cached is not None:
+            return cached
+
+        if _FC_APP is None:
              print("ERROR: FireCrawl_API_KEY environment variable not set.")
              return {"error": "FireCrawl API key not configured.", "success": False}
 
-        firecrawl_app = FirecrawlApp(api_key=fc_api_key)
-
-        results = firecrawl_app.deep_research(
-        query= query,
-        max_depth=5,
-        time_limit=180,
-        max_urls=10,
+        results = await _coalesced_deep_research(
+            preset,
+            query,
+            max_depth=max_depth,
+            time_limit=time_limit,
+            max_urls=max_urls,
         )
 
-        return {
+        # Failed jobs come back as a status model or {"success": False, "error": ...}
+        if not isinstance(results, dict):
+            results = results.model_dump()
+        data = results.get("data") or {}
+        if not results.get("success") or not data.get("finalAnalysis"):
+            error = results.get("error") or "No analysis returned."
+            print(f"ERROR: Deep research returned no result for '{query}': {error}")
+            return {"error": error, "success": False, "final_analysis": "Deep research failed.", "sources_count": 0, "sources": []}
+
+        sources = data.get("sources", [])
+        response = {
             "success": True,
-            "final_analysis": results.get("data", {}).get("finalAnalysis", "No analysis found."),
-            "sources_count": len(results.get("data", {}).get("sources", [])),
-            "sources": results.get("data", {}).get("sources", [])
+            "final_analysis": data["finalAnalysis"],
+            "sources_count": len(sources),
+            "sources": sources
         }
+        await research_cache.set(preset, query, response, ttl=cache_ttl)
+        return response
 
     except Exception as e:
         print(f"ERROR: Deep research tool execution failed for '{query}': {e}")
         return {"error": str(e), "success": False, "final_analysis": "Deep research failed.", "sources_count": 0, "sources": []}
 
+
+@function_tool
+async def research_topic(
+    query: str,
+    max_depth: int,
+    time_limit: int,
+    max_urls: int
+) -> Dict[str, Any]:
+    """
+    Web-search via FireCrawl API for the latest, authentic sources.**Immediately retry** if the retrieved data timestamp is older than the current timestamp.
+    Perform a quick web search for a given topic, returning latest information and summaries from a few top results.
+    Use this for general questions or when a brief overview is needed. Do NOT use for deep analysis or synthesis.
+    Requires parameters: query (str), max_depth (int, e.g., 5), time_limit (int, seconds, e.g., 180), max_urls (int, e.g., 10). Always use max_depth=5, time_limit=180, max_urls=10 unless the user specifies different numbers.
+    """
+    return await _fc(query, "quick")
+
 @function_tool
 async def deep_research(
     query: str,
@@ -124,34 +197,7 @@ async def deep_research(
     Use this when you need to get the most **up-to-date information, especially concerning events or data from 2025 onwards**, which might not be in your training data.
     Requires parameters: query (str), max_depth (int, e.g., 10), time_limit (int, seconds, e.g., 300), max_urls (int, e.g., 50). Always use max_depth=10, time_limit=300, max_urls=50 unless the user specifies different numbers.
     """
-    if FirecrawlApp is None:
-        print("ERROR: firecrawl-python library is required for deep_research but not installed.")
-        return {"error": "Deep research tool dependency missing.", "success": False}
-
-    try:
-        fc_api_key = os.getenv("FireCrawl_API_KEY")
-        if not fc_api_key:
-             print("ERROR: FireCrawl_API_KEY environment variable not set.")
-             return {"error": "FireCrawl API key not configured.", "success": False}
-
-        firecrawl_app = FirecrawlApp(api_key=fc_api_key)
-
-        results = firecrawl_app.deep_research(
-        query= query,
-        max_depth=10,
-        time_limit=300,
-        max_urls=50,
-        )
-        return {
-            "success": True,
-            "final_analysis": results.get("data", {}).get("finalAnalysis", "No analysis found."),
-            "sources_count": len(results.get("data", {}).get("sources", [])),
-            "sources": results.get("data", {}).get("sources", [])
-        }
-
-    except Exception as e:
-        print(f"ERROR: Deep research tool execution failed for '{query}': {e}")
-        return {"error": str(e), "success": False, "final_analysis": "Deep research failed.", "sources_count": 0, "sources": []}
+    return await _fc(query, "deep")
 
 
 
@@ -175,38 +221,16 @@ Parameters:
   • time_limit (int): Total seconds allotted (default: 300).
   • max_urls (int): Max URLs to fetch (default: 50).
     """
-    if FirecrawlApp is None:
-        print("ERROR: firecrawl-python library is required for deep_research but not installed.")
-        return {"error": "Deep research tool dependency missing.", "success": False}
-
-    try:
-        fc_api_key = os.getenv("FireCrawl_API_KEY")
-        if not fc_api_key:
-             print("ERROR: FireCrawl_API_KEY environment variable not set.")
-             return {"error": "FireCrawl API key not configured.", "success": False}
-
-        firecrawl_app = FirecrawlApp(api_key=fc_api_key)
-
-        results = firecrawl_app.deep_research(
-        query= query,
-        max_depth=10,
-        time_limit=300,
-        max_urls=50,
-        )
-
-        return {
-            "success": True,
-            "final_analysis": results.get("data", {}).get("finalAnalysis", "No analysis found."),
-            "sources_count": len(results.get("data", {}).get("sources", [])),
-            "sources": results.get("data", {}).get("sources", [])
-        }
-
-    except Exception as e:
-        print(f"ERROR: Deep research tool execution failed for '{query}': {e}")
-        return {"error": str(e), "success": False, "final_analysis": "Deep research failed.", "sources_count": 0, "sources": []}
+    return await _fc(query, "financial")
     
     
 
+@lru_cache(maxsize=512)
+def _tz(name: str):
+    """Resolve a timezone name once; unknown names raise and are not cached."""
+    return pytz.timezone(name)
+
+
 @function_tool
 def get_current_time_in_country(country_tz: str = "Asia/Karachi") -> str:
     """
@@ -215,7 +239,7 @@ def get_current_time_in_country(country_tz: str = "Asia/Karachi") -> str:
     Use this ONLY for questions about the current time.
     """
     try:
-        tz = pytz.timezone(country_tz)
+        tz = _tz(country_tz)
         now = datetime.now(tz)
         return now.strftime("%Y-%m-%d %H:%M:%S")
     except pytz.UnknownTimeZoneError:
@@ -318,6 +342,27 @@ If the query is about deep research on any topic including financial topics, you
 )
 
 
+# --------------------------------------------------------------------------
+# History Summarization
+# --------------------------------------------------------------------------
+
+async def summarize_history(messages: List[Dict[str, Any]]) -> str:
+    """One-shot Gemini call that condenses older chat messages into a short summary."""
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    response = await provider.chat.completions.create(
+        model=GEMINI_MODEL,
+        messages=[
+            {
+                "role": "system",
+                "content": "Summarize this conversation so it can replace the original messages. "
+                           "Keep facts, figures, names, dates, user preferences and open questions.",
+            },
+            {"role": "user", "content": transcript},
+        ],
+    )
+    return response.choices[0].message.content
+
+
 # --------------------------------------------------------------------------
 # The agent, tools, provider, model, and run_config are now defined
 # --------------------------------------------------------------------------
\ No newline at end of file
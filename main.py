@@ -1,20 +1,32 @@
 import os
+import re
+import asyncio
 import uuid
+import time
+import hashlib
 import logging
-from typing import List, Optional, Any
+from typing import Dict, List, Optional, Any
 from contextlib import asynccontextmanager
 
-from fastapi import FastAPI, HTTPException, status, Body
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, HTTPException, Request, Query
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 from datetime import datetime
 from passlib.context import CryptContext
+from cachetools import TTLCache
+from openai.types.responses import ResponseTextDeltaEvent
+import orjson
+import msgspec
 
 from prisma_client import Prisma, Json
 from dotenv import load_dotenv, find_dotenv
 
+# Imported at startup so the agents and Gemini client are built before the first request
+from agent_core import agent, run_config, Runner, summarize_history
+
 # Load environment variables
 load_dotenv(find_dotenv())
 
@@ -34,10 +46,51 @@ logger = logging.getLogger(__name__)
 
 # Password hashing
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Anon users get a random password nobody knows, so minimum bcrypt cost is enough;
+# the hashes still verify with pwd_context
+anon_pwd_context = CryptContext(schemes=["bcrypt"], bcrypt__rounds=4)
+
+# Recent replies: reply_key(session_id, history ending in the user message) -> (saved_at, agent reply)
+reply_cache: TTLCache = TTLCache(maxsize=10_000, ttl=600)
+# Seconds after a turn is saved during which the same message again counts as a client retry;
+# later repeats ("continue", "yes", ...) are new turns
+RETRY_WINDOW_SECONDS = 10
+
+# Upper bound on rows returned by paginated listing endpoints
+MAX_PAGE_SIZE = 500
+
+# Histories longer than this are compacted to a summary plus the most recent messages
+MAX_HISTORY_MESSAGES = 40
+KEEP_RECENT_MESSAGES = 20
+# Seconds the summarization call may take before compaction is skipped
+COMPACTION_TIMEOUT = 30
+
+# Prompts asking for live data must always reach the agent
+FRESH_DATA_PATTERN = re.compile(r"\b(now|today|current|latest|live|price|prices)\b", re.IGNORECASE)
 
 # Initialize Prisma client
 prisma = Prisma()
 
+# Json wrapper encoded with orjson instead of the stdlib encoder Prisma uses by default.
+# The serializer hook is private to prisma-client-py (pinned in requirements.txt), so
+# fall back to plain Json if it moves.
+try:
+    from prisma_client._builder import serializer
+
+    class FastJson(Json):
+        pass
+
+    @serializer.register(FastJson)
+    def serialize_fast_json(obj: FastJson) -> str:
+        try:
+            return orjson.dumps(obj.data).decode()
+        except orjson.JSONEncodeError:
+            # e.g. integers beyond 64 bits or Decimals: use Prisma's own encoder
+            return serializer.dispatch(Json)(obj)
+except ImportError:
+    logger.warning("prisma_client._builder.serializer not found; using stdlib Json encoding")
+    FastJson = Json
+
 # Lifespan context for startup/shutdown
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -52,6 +105,7 @@ app = FastAPI(
     title="Search Agent API",
     version="1.0.0",
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 # CORS
@@ -65,13 +119,21 @@ app.add_middleware(
 
 # ---------------------- Models ----------------------
 
-class ChatRequest(BaseModel):
+# msgspec decodes and validates the hot /chat body in a single C call
+class ChatRequest(msgspec.Struct):
     message:     str
-    session_id:  Optional[str] = Body(None, alias="session_id")
-    user_id:     Optional[str] = Body(None, alias="user_id")
-
-    class Config:
-        allow_population_by_field_name = True
+    session_id:  Optional[str] = None
+    user_id:     Optional[str] = None
+
+# /chat reads its body by hand, so its OpenAPI request body is declared from the Struct
+CHAT_REQUEST_BODY = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/json": {"schema": msgspec.json.schema(ChatRequest)["$defs"]["ChatRequest"]},
+        },
+    },
+}
 
 class UserModel(BaseModel):
     email:           str
@@ -88,16 +150,19 @@ class UserModel(BaseModel):
     notifications:   List[dict]     = []
 
 class UserUpdateModel(BaseModel):
-    email:           Optional[str]
-    password:        Optional[str]
-    isSubscribed:    Optional[bool]
-    subscription:    Optional[dict]
-    freePlanUsage:   Optional[dict]
-    role:            Optional[str]
-    paymentStatus:   Optional[str]
-    plan:            Optional[str]
-    agentSessions:   Optional[List[dict]]
-    notifications:   Optional[List[dict]]
+    email:           Optional[str]        = None
+    password:        Optional[str]        = None
+    isSubscribed:    Optional[bool]       = None
+    subscription:    Optional[dict]       = None
+    freePlanUsage:   Optional[dict]       = None
+    role:            Optional[str]        = None
+    paymentStatus:   Optional[str]        = None
+    plan:            Optional[str]        = None
+    agentSessions:   Optional[List[dict]] = None
+    notifications:   Optional[List[dict]] = None
+
+# UserUpdateModel fields stored as JSON/array columns
+JSON_USER_FIELDS = frozenset({"subscription", "freePlanUsage", "agentSessions", "notifications"})
 
 class LoginRequest(BaseModel):
     email:    str
@@ -105,31 +170,170 @@ class LoginRequest(BaseModel):
 
 # ---------------------- Chat Endpoints ----------------------
 
-@app.post("/chat")
-async def handle_chat_message(chat_request: ChatRequest):
-    # 1) Verify provided user_id exists
+def sse_event(payload: dict) -> str:
+    """Format a payload as a server-sent event."""
+    return f"data: {orjson.dumps(payload).decode()}\n\n"
+
+
+# msgspec error suffix locating the bad value, e.g. "... - at `$.message`"; the wording
+# is not API, so msgspec is pinned in requirements.txt
+MSGSPEC_ERROR_PATH = re.compile(r" - at `\$(.*)`$")
+MSGSPEC_MISSING_FIELD = re.compile(r"^Object missing required field `(\w+)`")
+
+
+def chat_request_errors(body: bytes, e: msgspec.DecodeError) -> List[dict]:
+    """Translate a msgspec decode error into FastAPI's list of validation errors."""
+    if not body:
+        return [{"type": "missing", "loc": ["body"], "msg": "Field required", "input": None}]
+    if not isinstance(e, msgspec.ValidationError):
+        return [{"type": "json_invalid", "loc": ["body"], "msg": "JSON decode error", "ctx": {"error": str(e)}}]
+
+    msg = str(e)
+    loc: List[Any] = ["body"]
+    if match := MSGSPEC_ERROR_PATH.search(msg):
+        msg = msg[:match.start()]
+        loc += [int(part[1:-1]) if part.startswith("[") else part[1:]
+                for part in re.findall(r"\.\w+|\[\d+\]", match.group(1))]
+    if match := MSGSPEC_MISSING_FIELD.match(msg):
+        return [{"type": "missing", "loc": loc + [match.group(1)], "msg": "Field required"}]
+    return [{"type": "type_error" if msg.startswith("Expected") else "value_error", "loc": loc, "msg": msg}]
+
+
+def reply_key(session_id: str, history: List[dict]) -> str:
+    """Key for the reply to a session's history, which ends with the user message being answered."""
+    return hashlib.sha256(orjson.dumps([session_id, history], option=orjson.OPT_SORT_KEYS)).hexdigest()
+
+
+# Running agent turns; holds a strong reference so a turn outlives a disconnected client
+_background_tasks: set = set()
+
+# Running agent turns by reply_key, so concurrent duplicate submits share one run
+_inflight_turns: Dict[str, asyncio.Task] = {}
+
+
+def _forget_task(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled():
+        # Failures are logged where they happen; mark them retrieved for asyncio
+        task.exception()
+
+
+async def run_agent_turn(
+    session,
+    history: List[dict],
+    cache_key: str,
+    deltas: asyncio.Queue,
+) -> str:
+    """
+    Run the agent on history, pushing text deltas onto the queue, then save the turn.
+    Runs as its own task so the turn is persisted even if the client disconnects mid-stream.
+    """
+    try:
+        result = Runner.run_streamed(agent, input=history, run_config=run_config)
+        async for event in result.stream_events():
+            if event.type == "raw_response_event" and isinstance(event.data, ResponseTextDeltaEvent):
+                deltas.put_nowait(event.data.delta)
+        agent_reply = result.final_output
+
+        history.append({"role": "assistant", "content": agent_reply})
+        await prisma.chatsession.update(
+            where={"id": session.id},
+            data={"history": FastJson(history)}
+        )
+        reply_cache[cache_key] = (time.monotonic(), agent_reply)
+
+        # Compact after the save, off the reply path, so it never delays a response
+        if len(history) > MAX_HISTORY_MESSAGES:
+            task = asyncio.create_task(compact_history(session, history))
+            _background_tasks.add(task)
+            task.add_done_callback(_forget_task)
+        return agent_reply
+
+    except Exception as e:
+        logger.error(f"Error in session {session.session_id}: {e}", exc_info=True)
+        raise
+    finally:
+        # End-of-stream marker for the SSE generator
+        deltas.put_nowait(None)
+
+
+async def compact_history(session, history: List[dict]) -> None:
+    """Replace older messages of a saved history with a summary, keeping the most recent ones."""
+    try:
+        summary = await asyncio.wait_for(
+            summarize_history(history[1:-KEEP_RECENT_MESSAGES]),
+            timeout=COMPACTION_TIMEOUT,
+        )
+        if not summary:
+            raise ValueError("summarizer returned no content")
+        compacted = [
+            history[0],
+            {"role": "system", "content": f"Summary of prior conversation: {summary}"},
+            *history[-KEEP_RECENT_MESSAGES:],
+        ]
+
+        # Skip if another turn was saved while summarizing, rather than overwrite it
+        current = await prisma.chatsession.find_unique(where={"id": session.id})
+        if current is None or len(current.history or []) != len(history):
+            logger.info(f"Skipped compaction for session {session.session_id}: history changed")
+            return
+        await prisma.chatsession.update(
+            where={"id": session.id},
+            data={"history": FastJson(compacted)}
+        )
+        # A retry of the last message must still match the compacted history; the retry
+        # window keeps counting from when the turn itself was saved
+        cached = reply_cache.get(reply_key(session.session_id, history[:-1]))
+        if cached is not None:
+            reply_cache[reply_key(session.session_id, compacted[:-1])] = cached
+        logger.info(f"Compacted history for session {session.session_id}")
+    except asyncio.TimeoutError:
+        logger.error(f"History compaction timed out after {COMPACTION_TIMEOUT}s for {session.session_id}")
+    except Exception as e:
+        logger.error(f"History compaction failed for {session.session_id}: {e}", exc_info=True)
+
+
+@app.post("/chat", openapi_extra=CHAT_REQUEST_BODY)
+async def handle_chat_message(request: Request):
+    body = await request.body()
+    try:
+        chat_request = msgspec.json.decode(body, type=ChatRequest)
+    except msgspec.DecodeError as e:
+        # ValidationError subclasses DecodeError
+        raise RequestValidationError(chat_request_errors(body, e))
+
+    # 1) Verify provided user_id exists; without a session_id its latest
+    #    session is looked up concurrently since the two reads are independent
     user_id = chat_request.user_id
+    session_id = chat_request.session_id
+    user_rec = None
+    last = None
     if user_id:
-        if not await prisma.user.find_unique(where={"id": user_id}):
+        if session_id:
+            user_rec = await prisma.user.find_unique(where={"id": user_id})
+        else:
+            user_rec, last = await asyncio.gather(
+                prisma.user.find_unique(where={"id": user_id}),
+                prisma.chatsession.find_first(
+                    where={"user_id": user_id},
+                    order={"created_at": "desc"}
+                ),
+            )
+        if not user_rec:
             user_id = None
 
-    # 2) Auto-create anon user if none
+    # 2) Auto-create anon user if none (a new user has no previous session)
     if not user_id:
         anon_email = f"anon_{uuid.uuid4().hex}@example.com"
-        anon_password = pwd_context.hash(uuid.uuid4().hex)
-        new_user = await prisma.user.create(
+        anon_password = await asyncio.to_thread(anon_pwd_context.hash, uuid.uuid4().hex)
+        user_rec = await prisma.user.create(
             data={"email": anon_email, "password": anon_password}
         )
-        user_id = new_user.id
+        user_id = user_rec.id
         logger.info(f"Auto-created anon user: {user_id}")
 
     # 3) Reuse last session if no session_id supplied
-    session_id = chat_request.session_id
     if not session_id:
-        last = await prisma.chatsession.find_first(
-            where={"user_id": user_id},
-            order={"created_at": "desc"}
-        )
         session_id = last.session_id if last else str(uuid.uuid4())
 
     message = chat_request.message
@@ -142,18 +346,17 @@ async def handle_chat_message(chat_request: ChatRequest):
             data={
                 "session_id": session_id,
                 "user_id":    user_id,
-                "history":    Json([{"role": "system", "content": "I am Deep Search Agent!"}]),
+                "history":    FastJson([{"role": "system", "content": "I am Deep Search Agent!"}]),
             }
         )
         logger.info(f"Created session: {session_id}")
 
-        # Push notification
+        # Push notification (user_rec was loaded or created above)
         try:
-            user_rec = await prisma.user.find_unique(where={"id": user_id})
             notifs = user_rec.notifications or []
             await prisma.user.update(
                 where={"id": user_id},
-                data={"notifications": Json(notifs + [{"user_id": user_id}])}
+                data={"notifications": FastJson(notifs + [{"user_id": user_id}])}
             )
             logger.info(f"Notification added for user {user_id}")
         except Exception as e:
@@ -166,44 +369,64 @@ async def handle_chat_message(chat_request: ChatRequest):
             )
         session.history = session.history or []
 
-    # 5) Append user message
+    # 5) Answer the message. deltas is set only when this request runs the agent itself;
+    #    otherwise the full reply is sent as a single delta
     history = session.history
-    history.append({"role": "user", "content": message})
-
-    try:
-        # 6) Invoke agent
-        from agent_core import agent, run_config, Runner
-        result = Runner.run_streamed(agent, input=history, run_config=run_config)
-        async for _ in result.stream_events():
-            pass
-        agent_reply = result.final_output
+    deltas: Optional[asyncio.Queue] = None
+    cached = None
+    if (
+        len(history) >= 2
+        and history[-1].get("role") == "assistant"
+        and history[-2].get("role") == "user"
+        and history[-2].get("content") == message
+        and not FRESH_DATA_PATTERN.search(message)
+    ):
+        cached = reply_cache.get(reply_key(session_id, history[:-1]))
+    if cached is not None and time.monotonic() - cached[0] < RETRY_WINDOW_SECONDS:
+        # Retry of the turn that was just saved: replay its reply
+        logger.info(f"Replaying cached reply for session {session_id}")
+        turn = asyncio.get_running_loop().create_future()
+        turn.set_result(cached[1])
+    else:
+        history.append({"role": "user", "content": message})
+        key = reply_key(session_id, history)
+        turn = _inflight_turns.get(key)
+        if turn is None:
+            # Run the agent in its own task and stream its deltas to the client
+            deltas = asyncio.Queue()
+            turn = asyncio.create_task(run_agent_turn(session, history, key, deltas))
+            _inflight_turns[key] = turn
+            _background_tasks.add(turn)
+            turn.add_done_callback(_forget_task)
+            turn.add_done_callback(lambda _: _inflight_turns.pop(key, None))
+        else:
+            # Duplicate submit while the same turn is running: share its result
+            logger.info(f"Joining in-flight turn for session {session_id}")
 
-        # 7) Append assistant reply & update session
-        history.append({"role": "assistant", "content": agent_reply})
-        await prisma.chatsession.update(
-            where={"id": session.id},
-            data={"history": Json(history)}
-        )
+    async def event_stream():
+        try:
+            if deltas is not None:
+                while (delta := await deltas.get()) is not None:
+                    yield sse_event({"delta": delta})
+            # shield: a disconnect cancels this generator, never the turn itself
+            agent_reply = await asyncio.shield(turn)
+            if deltas is None:
+                yield sse_event({"delta": agent_reply})
+
+            # 6) Signal completion with the full reply
+            yield sse_event({
+                "done":      True,
+                "sessionId": session_id,
+                "userId":    user_id,
+                "prompt":    message,
+                "reply":     agent_reply
+            })
 
-        # 8) Return response
-        return JSONResponse(
-            content={
-                "statusCode": status.HTTP_200_OK,
-                "success": True,
-                "message": "Response processed successfully.",
-                "data": {
-                    "sessionId": session_id,
-                    "userId":    user_id,
-                    "prompt":    message,
-                    "reply":     agent_reply
-                }
-            },
-            status_code=status.HTTP_200_OK
-        )
+        except Exception as e:
+            # Headers are already sent, so report the failure in-band
+            yield sse_event({"done": True, "error": str(e), "sessionId": session_id})
 
-    except Exception as e:
-        logger.error(f"Error in session {session_id}: {e}", exc_info=True)
-        raise HTTPException(status_code=500, detail=str(e))
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 # ---------------------- Session Endpoints ----------------------
 
@@ -217,8 +440,8 @@ async def get_session_history(session_id: str):
 
 @app.delete("/sessions/{session_id}")
 async def delete_session(session_id: str):
-    deleted_count = await prisma.chatsession.delete_many(where={"session_id": session_id})
-    if deleted_count == 0:
+    deleted = await prisma.chatsession.delete(where={"session_id": session_id})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="Session not found")
     return {"deleted": True, "sessionId": session_id}
 
@@ -246,8 +469,15 @@ async def delete_sessions_by_user(user_id: str):
 
 
 @app.get("/chathistories")
-async def get_all_chathistories():
-    sessions = await prisma.chatsession.find_many()
+async def get_all_chathistories(
+    skip: int = Query(0, ge=0),
+    take: int = Query(100, ge=1)
+):
+    sessions = await prisma.chatsession.find_many(
+        skip=skip,
+        take=min(take, MAX_PAGE_SIZE),
+        order={"created_at": "desc"}
+    )
     return {
         "chathistories": [
             {"sessionId": s.session_id, "history": s.history}
@@ -255,15 +485,29 @@ async def get_all_chathistories():
         ]
     }
 
+
+@app.get("/chathistories/ids")
+async def get_all_chathistory_ids(
+    skip: int = Query(0, ge=0),
+    take: int = Query(100, ge=1)
+):
+    # Raw query so the (large) history column is never read
+    rows = await prisma.query_raw(
+        'SELECT session_id FROM "chat-histories" ORDER BY created_at DESC OFFSET $1 LIMIT $2',
+        skip,
+        min(take, MAX_PAGE_SIZE),
+    )
+    return {"sessionIds": [r["session_id"] for r in rows]}
+
 # ---------------------- User Endpoints ----------------------
 
 @app.post("/users", status_code=201)
 async def create_user(user: UserModel):
     data = user.dict(exclude={"agentSessions", "notifications", "createdAt", "updatedAt"})
-    data["password"] = pwd_context.hash(user.password)
+    data["password"] = await asyncio.to_thread(pwd_context.hash, user.password)
     # wrap JSON fields
-    data["subscription"]  = Json(data.get("subscription", {}))
-    data["freePlanUsage"] = Json(data.get("freePlanUsage", {}))
+    data["subscription"]  = FastJson(data.get("subscription", {}))
+    data["freePlanUsage"] = FastJson(data.get("freePlanUsage", {}))
     new = await prisma.user.create(data=data)
     return {"status": "created", "userId": new.id}
 
@@ -292,50 +536,26 @@ async def get_user(user_id: str):
 
 
 @app.put("/users/{user_id}")
-async def update_user(
-    user_id: str,
-    up: dict = Body(..., description="Fields to update on the user")
-):
-    # Define which top‐level fields are valid on the User model
-    valid_fields = {
-        "email",
-        "password",
-        "isSubscribed",
-        "subscription",
-        "freePlanUsage",
-        "role",
-        "paymentStatus",
-        "plan",
-        "agentSessions",
-        "notifications",
-    }
+async def update_user(user_id: str, up: UserUpdateModel):
+    # Only fields the client actually sent; unknown keys are dropped by the model
+    data: dict[str, Any] = up.model_dump(exclude_unset=True, exclude_none=True)
 
-    # Build a clean dict of only the valid fields
-    data: dict[str, Any] = {}
-    for key, value in up.items():
-        if key not in valid_fields:
-            # skip any unknown keys rather than trying to write them directly
-            continue
-
-        if key == "password":
-            # hash new passwords
-            data["password"] = pwd_context.hash(value)
-        elif key in {"subscription", "freePlanUsage", "agentSessions", "notifications"}:
-            # wrap JSON/array fields
-            data[key] = Json(value)
-        else:
-            # primitive scalar fields
-            data[key] = value
+    if "password" in data:
+        # hash new passwords
+        data["password"] = await asyncio.to_thread(pwd_context.hash, data["password"])
+
+    # wrap JSON/array fields
+    data.update({key: FastJson(data[key]) for key in JSON_USER_FIELDS & data.keys()})
 
     # Always update the timestamp
     data["updatedAt"] = datetime.utcnow()
 
-    # Perform the update
-    updated_count = await prisma.user.update_many(
+    # Perform the update (single-row update returns None when the id doesn't exist)
+    updated = await prisma.user.update(
         where={"id": user_id},
         data=data
     )
-    if updated_count == 0:
+    if updated is None:
         raise HTTPException(status_code=404, detail="User not found")
 
     return {"status": "updated", "userId": user_id}
@@ -345,9 +565,9 @@ async def update_user(
 
 @app.delete("/users/{user_id}")
 async def delete_user(user_id: str):
-    # delete_many returns the number of records deleted
-    deleted_count = await prisma.user.delete_many(where={"id": user_id})
-    if deleted_count == 0:
+    # delete returns None when the id doesn't exist
+    deleted = await prisma.user.delete(where={"id": user_id})
+    if deleted is None:
         raise HTTPException(status_code=404, detail="User not found")
     return {"deleted": True, "userId": user_id}
 
@@ -357,6 +577,6 @@ async def delete_user(user_id: str):
 @app.post("/login")
 async def login(req: LoginRequest):
     u = await prisma.user.find_unique(where={"email": req.email})
-    if not u or not pwd_context.verify(req.password, u.password):
+    if not u or not await asyncio.to_thread(pwd_context.verify, req.password, u.password):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     return {"status": "ok", "userId": u.id}
@@ -0,0 +1,2 @@
+-- CreateIndex
+CREATE INDEX "chat-histories_user_id_created_at_idx" ON "chat-histories"("user_id", "created_at" DESC);
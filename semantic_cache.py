@@ -0,0 +1,212 @@
+# --------------------------------------------------------------------------
+# semantic_cache.py: Semantic response cache for the FireCrawl research tools.
+# --------------------------------------------------------------------------
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional, Tuple
+
+from cachetools import TLRUCache
+from dotenv import load_dotenv, find_dotenv
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    print("Install 'redis' to share the research cache between workers: uv add redis")
+    aioredis = None
+
+# faiss, numpy and sentence-transformers (which pulls in torch) are imported with the
+# embedding model on first use, so importing this module stays cheap in every worker
+faiss = None
+np = None
+
+
+# Load environment variables needed by the cache (e.g., REDIS_URL)
+load_dotenv(find_dotenv())
+
+# Cosine similarity above which two queries are treated as the same question
+SIMILARITY_THRESHOLD = 0.92
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+
+# Seconds a Redis command may take before the cache gives up and reports a miss
+REDIS_TIMEOUT = 2.0
+
+# Bounds on process memory: in-process payloads and indexed queries per tool
+LOCAL_CACHE_MAXSIZE = 256
+MAX_INDEX_ENTRIES = 1000
+# Neighbours checked per lookup, so an expired best match doesn't hide a live one
+SEARCH_K = 5
+
+
+def normalize_query(query: str) -> str:
+    """Lower-case and collapse whitespace so trivially different queries share a key."""
+    return " ".join(query.lower().split())
+
+
+def _load_embedding_model():
+    """Import the embedding stack and load the model. Called once, under SemanticCache._model_lock."""
+    global faiss, np
+    import faiss as _faiss
+    import numpy as _np
+    from sentence_transformers import SentenceTransformer
+
+    faiss, np = _faiss, _np
+    return SentenceTransformer(EMBEDDING_MODEL)
+
+
+class _ToolIndex:
+    """FAISS index over one tool's cached queries, rebuilt without expired entries on every write."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+        # cache key -> (expires_at, embedding), oldest first
+        self.entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.index = faiss.IndexFlatIP(dim)
+        self.keys: List[str] = []
+
+    def add(self, key: str, emb, ttl: int) -> None:
+        now = time.monotonic()
+        self.entries.pop(key, None)
+        self.entries[key] = (now + ttl, emb)
+        for expired in [k for k, (expires_at, _) in self.entries.items() if expires_at < now]:
+            del self.entries[expired]
+        while len(self.entries) > MAX_INDEX_ENTRIES:
+            self.entries.popitem(last=False)
+
+        self.keys = list(self.entries)
+        self.index = faiss.IndexFlatIP(self.dim)
+        self.index.add(np.vstack([e for _, e in self.entries.values()]))
+
+    def search(self, emb, threshold: float) -> List[str]:
+        """Keys of unexpired entries scoring >= threshold, best match first."""
+        if not self.keys:
+            return []
+        now = time.monotonic()
+        scores, ids = self.index.search(emb, min(SEARCH_K, len(self.keys)))
+        return [
+            self.keys[i]
+            for score, i in zip(scores[0], ids[0])
+            if i >= 0 and score >= threshold and self.entries[self.keys[i]][0] >= now
+        ]
+
+
+class SemanticCache:
+    """
+    Two-tier cache for tool results, keyed by (tool_name, query).
+    Tier 1 is an exact lookup on sha256 of the normalized query.
+    Tier 2 embeds the query and searches a per-tool FAISS inner-product index
+    for a previously cached query with cosine similarity >= threshold.
+    Values live in Redis (SETEX) when REDIS_URL is set, otherwise in process memory.
+    Redis I/O is async and embedding runs in a worker thread, so the event loop never blocks.
+    """
+
+    def __init__(self, redis_url: Optional[str] = None, threshold: float = SIMILARITY_THRESHOLD):
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+
+        self._redis = None
+        if aioredis is not None and redis_url:
+            self._redis = aioredis.Redis.from_url(
+                redis_url,
+                socket_timeout=REDIS_TIMEOUT,
+                socket_connect_timeout=REDIS_TIMEOUT,
+            )
+        # Per-entry TTL: each value is stored as (ttl, payload)
+        self._local: TLRUCache = TLRUCache(
+            maxsize=LOCAL_CACHE_MAXSIZE,
+            ttu=lambda _key, value, now: now + value[0],
+        )
+
+        # The embedding model is loaded on first use, not at import
+        self._model = None
+        self._model_failed = False
+        self._model_lock = threading.Lock()
+        self._indexes: Dict[str, _ToolIndex] = {}
+
+    def key(self, tool: str, query: str) -> str:
+        digest = hashlib.sha256(normalize_query(query).encode("utf-8")).hexdigest()
+        return f"{tool}:{digest}"
+
+    async def get(self, tool: str, query: str) -> Optional[Dict[str, Any]]:
+        value = await self._load(self.key(tool, query))
+        if value is None and tool in self._indexes:
+            emb = await self._embed(query)
+            if emb is not None:
+                for key in self._indexes[tool].search(emb, self.threshold):
+                    value = await self._load(key)
+                    if value is not None:
+                        break
+
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value
+
+    async def set(self, tool: str, query: str, value: Dict[str, Any], ttl: int) -> None:
+        key = self.key(tool, query)
+        payload = json.dumps(value)
+        if self._redis is not None:
+            try:
+                await self._redis.setex(key, ttl, payload)
+            except Exception as e:
+                print(f"ERROR: Redis SETEX failed for '{key}': {e}")
+                return
+        else:
+            self._local[key] = (ttl, payload)
+
+        emb = await self._embed(query)
+        if emb is not None:
+            if tool not in self._indexes:
+                self._indexes[tool] = _ToolIndex(emb.shape[1])
+            self._indexes[tool].add(key, emb, ttl)
+
+    async def _embed(self, query: str):
+        """Embed a query in a worker thread; None when no embedding model is available."""
+        if self._model_failed:
+            return None
+        try:
+            return await asyncio.to_thread(self._encode, query)
+        except Exception as e:
+            print(f"ERROR: Embedding failed for '{query}': {e}")
+            return None
+
+    def _encode(self, query: str):
+        with self._model_lock:
+            if self._model is None and not self._model_failed:
+                try:
+                    self._model = _load_embedding_model()
+                except ImportError:
+                    print("Install 'sentence-transformers' and 'faiss-cpu' for semantic cache lookups: uv add sentence-transformers faiss-cpu")
+                    self._model_failed = True
+                except Exception as e:
+                    print(f"ERROR: Could not load embedding model '{EMBEDDING_MODEL}', using exact-match cache only: {e}")
+                    self._model_failed = True
+        if self._model is None:
+            return None
+        # Normalized vectors make inner product equal to cosine similarity
+        emb = self._model.encode([normalize_query(query)], normalize_embeddings=True)
+        return np.asarray(emb, dtype="float32")
+
+    async def _load(self, key: str) -> Optional[Dict[str, Any]]:
+        if self._redis is not None:
+            try:
+                payload = await self._redis.get(key)
+            except Exception as e:
+                print(f"ERROR: Redis GET failed for '{key}': {e}")
+                return None
+        else:
+            entry = self._local.get(key)
+            if entry is None:
+                return None
+            _, payload = entry
+        return json.loads(payload) if payload is not None else None
+
+
+research_cache = SemanticCache(redis_url=os.getenv("REDIS_URL"))